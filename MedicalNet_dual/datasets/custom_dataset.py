@@ -3,41 +3,117 @@ Custom dataset for brain tumor classification, T1+T2 hybrid
 Sidi Liang, 2022-2023
 '''
 
+import hashlib
 import math
 import os
-import pathlib
 import random
 
 import numpy as np
 from torch.utils.data import Dataset
 import nibabel
-from scipy import ndimage
 from typing import Tuple, List, Dict
 
+try:
+    import SimpleITK as sitk
+except ImportError:
+    sitk = None
+
+try:
+    from utils.preprocess_numba import resize_normalize
+except ImportError:
+    resize_normalize = None
+
+
+def _load_volume(path):
+    """
+    Load a NIfTI volume in nibabel's (x, y, z) axis order
+    SimpleITK decodes .nii.gz much faster than nibabel and is used when installed,
+    otherwise the lazy nibabel array proxy is returned
+    """
+    if sitk is not None:
+        # SimpleITK returns (z, y, x), transpose back as a view to keep the layout the pipeline expects
+        return sitk.GetArrayFromImage(sitk.ReadImage(str(path))).transpose(2, 1, 0)
+    # no memory map, it can make reading large volumes many times slower
+    return nibabel.load(path, mmap=False).dataobj
+
+
+def _valid_bounds(mask):
+    """
+    Per-axis [lower, upper) bounds of the True region of a 3D mask, from 1-D any() reductions
+    """
+    lower, upper = [], []
+    for axes in ((1, 2), (0, 2), (0, 1)):
+        profile = mask.any(axis=axes)
+        lower.append(np.argmax(profile))
+        upper.append(len(profile) - np.argmax(profile[::-1]))
+    return np.array(lower), np.array(upper)
+
+
+def _nearest_index(in_size, out_size):
+    """
+    Source indices of a nearest neighbour resize along one axis, on the same
+    corner-aligned grid as ndimage.zoom(order=0)
+    """
+    if out_size == 1:
+        return np.zeros(1, dtype=np.intp)
+    return np.floor(np.arange(out_size) * ((in_size - 1) / (out_size - 1)) + 0.5).astype(np.intp)
+
+
+# version of the preprocessing output stored in --cache_dir, bump it whenever that output changes
+_CACHE_VERSION = 2
+
+# per-process pool of standard normal samples used as background noise
+_NOISE_POOL = None
+
+
+def _background_noise(count, pool_size):
+    """
+    count standard normal samples, read from a random offset of a pool that is only redrawn when too small
+    """
+    global _NOISE_POOL
+    if _NOISE_POOL is None or _NOISE_POOL.size < count:
+        _NOISE_POOL = np.random.standard_normal(max(pool_size, count)).astype(np.float32)
+    start = np.random.randint(0, _NOISE_POOL.size - count + 1)
+    return _NOISE_POOL[start:start + count]
+
+
+def _fill_background(volume):
+    """
+    Replace the NaN background of a preprocessed volume with gaussian noise, in place
+    """
+    background = np.isnan(volume)
+    volume[background] = _background_noise(np.count_nonzero(background), 4 * volume.size)
+    return volume
+
+
 class CustomTumorDataset(Dataset):
 
     def __init__(self, root_dir, sets):
 
+        self.root_dir = root_dir
+        self.input_D = sets.input_D
+        self.input_H = sets.input_H
+        self.input_W = sets.input_W
+        self.phase = sets.phase
+        print("Decoding volumes with {}".format("SimpleITK" if sitk is not None else "nibabel"))
+        print("Preprocessing training volumes with {}".format("numba" if resize_normalize is not None else "NumPy"))
+        self.cache_dir = sets.cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
         if self.phase == "test":
             with open(sets.data_list, 'r') as f:
                 self.data_list = [line.strip() for line in f]
                 print("Processing {} datas for classification".format(len(self.data_list)))
         elif self.phase == "train":
             self.classes, self.class_to_idx = self.__find_classes__(root_dir)
-
-        self.paths = list(pathlib.Path(root_dir).glob("*/*"))#folder containing the T1 and T2 images for one patient
-        self.root_dir = root_dir
-        self.input_D = sets.input_D
-        self.input_H = sets.input_H
-        self.input_W = sets.input_W
-        self.phase = sets.phase
-        self.t1_image_list = []
-        self.t2_image_list = []
+            self.samples = self.__find_samples__(root_dir)
 
     def __nii2tensorarray__(self, data):
-        [z, y, x] = data.shape
-        new_data = np.reshape(data, [z, y, x])
-        new_data = new_data.astype("float32")
+        # the network runs under autocast, emitting float16 halves the host to device transfer,
+        # clip so outliers do not overflow to inf, casting straight into a contiguous float16 buffer
+        new_data = np.empty(data.shape, dtype=np.float16)
+        np.clip(data, -20, 20, out=new_data)
 
         return new_data
 
@@ -68,26 +144,77 @@ class CustomTumorDataset(Dataset):
         class_to_idx = {cls_name: i for i, cls_name in enumerate(classes)}
         return classes, class_to_idx
 
+    def __cache_path__(self, *paths):
+        """
+        Path of the cached preprocessed volume for the given input files, None if caching is disabled
+        The key covers each file's path, mtime and size, the input size and _CACHE_VERSION,
+        so edited sources or a changed preprocessing never reuse a stale entry
+        """
+        if self.cache_dir is None:
+            return None
+        sources = []
+        for path in paths:
+            stat = os.stat(path)
+            sources.append("{}:{}:{}".format(os.path.abspath(str(path)), stat.st_mtime_ns, stat.st_size))
+        key = "{}|{}x{}x{}|v{}".format("|".join(sources), self.input_D, self.input_H, self.input_W, _CACHE_VERSION)
+        return os.path.join(self.cache_dir, hashlib.blake2b(key.encode()).hexdigest() + ".npy")
+
+    def __save_cache__(self, cache_path, img_array):
+        """
+        Write a preprocessed volume to the cache, atomically so concurrent workers never read a partial file
+        The volume is cached with its NaN background, so every epoch still draws fresh background noise
+        """
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, img_array)
+        os.replace(tmp_path, cache_path)
+
+    def __find_samples__(self, directory: str) -> List[Tuple[str, str, int]]:
+        """Finds the T1 and T2 images of every patient folder in a target directory.
+
+        Assumes target directory contains one folder per class, each containing one folder per patient.
+
+        Args:
+            directory (str): target directory to load samples from.
+
+        Returns:
+            List[Tuple[str, str, int]]: [(t1_image_path, t2_image_path, class_idx), ...]
+        """
+        samples = []
+        for class_name in self.classes:
+            patients = sorted((entry for entry in os.scandir(os.path.join(directory, class_name)) if entry.is_dir()),
+                              key=lambda entry: entry.name)
+            for patient in patients:
+                t1_image_path, t2_image_path = None, None
+                for entry in os.scandir(patient.path):
+                    if t1_image_path is None and entry.name.endswith("t1.nii.gz"):
+                        t1_image_path = entry.path
+                    elif t2_image_path is None and entry.name.endswith("t2.nii.gz"):
+                        t2_image_path = entry.path
+                if t1_image_path is None or t2_image_path is None:
+                    raise FileNotFoundError(f"Couldn't find both T1 and T2 images in {patient.path}.")
+                samples.append((t1_image_path, t2_image_path, self.class_to_idx[class_name]))
+        return samples
+
     def __len__(self):
-        return len(self.paths)
+        if self.phase == "test":
+            return len(self.data_list)
+        return len(self.samples)
 
     def __getitem__(self, idx):
 
         if self.phase == "train":
             # read image and labels
-            patient_path = self.paths[idx]
-            t1_image_path = list(patient_path.glob("*t1.nii.gz"))
-            print(patient_path)
-            t2_image_path = list(patient_path.glob("*t2.nii.gz"))
-            t1_image_path = t1_image_path[0]
-            assert os.path.isfile(t1_image_path)
-            self.t1_image_list.append(t1_image_path)
-            t2_image_path = t2_image_path[0]
-            self.t2_image_list.append(t2_image_path)
-            assert os.path.isfile(t2_image_path)
-            class_name  = self.paths[idx].parent.name
-            t1_img = nibabel.load(t1_image_path)  # We have transposed the data from WHD format to DHW
-            t2_img = nibabel.load(t2_image_path)
+            t1_image_path, t2_image_path, class_idx = self.samples[idx]
+            patient_path = os.path.dirname(t1_image_path)
+
+            cache_path = self.__cache_path__(t1_image_path, t2_image_path)
+            if cache_path is not None and os.path.exists(cache_path):
+                img_array = np.load(cache_path, mmap_mode='r').astype("float16")
+                return _fill_background(img_array), class_idx, patient_path
+
+            t1_img = _load_volume(t1_image_path)  # We have transposed the data from WHD format to DHW
+            t2_img = _load_volume(t2_image_path)
             assert t1_img is not None
             assert t2_img is not None
 
@@ -100,9 +227,10 @@ class CustomTumorDataset(Dataset):
             t2_img_array = self.__nii2tensorarray__(t2_img_array)
             img_array = np.array([t1_img_array, t2_img_array])
             #print(img_array.shape)
-            class_idx = self.class_to_idx[class_name]
+            if cache_path is not None:
+                self.__save_cache__(cache_path, img_array)
 
-            return img_array, class_idx, patient_path.__str__()
+            return _fill_background(img_array), class_idx, patient_path
 
         elif self.phase == "test":
             # WIP
@@ -127,8 +255,8 @@ class CustomTumorDataset(Dataset):
             assert os.path.isfile(t1_path)
             assert os.path.isfile(t2_path)
 
-            t1_img = nibabel.load(t1_path)
-            t2_img = nibabel.load(t2_path)
+            t1_img = _load_volume(t1_path)
+            t2_img = _load_volume(t2_path)
             assert t1_img is not None
             assert t2_img is not None
 
@@ -148,67 +276,50 @@ class CustomTumorDataset(Dataset):
         """
         Cut off the invalid area
         """
+        volume = np.asanyarray(volume)
         zero_value = volume[0, 0, 0]
-        non_zeros_idx = np.where(volume != zero_value)
-
-        [max_z, max_h, max_w] = np.max(np.array(non_zeros_idx), axis=1)
-        [min_z, min_h, min_w] = np.min(np.array(non_zeros_idx), axis=1)
+        [min_z, min_h, min_w], [max_z, max_h, max_w] = _valid_bounds(volume != zero_value)
 
         if label is not None:
+            label = np.asanyarray(label)
             return volume[min_z:max_z, min_h:max_h, min_w:max_w], label[min_z:max_z, min_h:max_h, min_w:max_w]
         else:
             return volume[min_z:max_z, min_h:max_h, min_w:max_w]
 
 
     def __random_center_crop__(self, data, label=None):
-        from random import random
         """
         Random crop
         """
         if label is not None:
-            target_indexs = np.where(label>0)
+            [min_target, max_target] = _valid_bounds(label > 0)
         else:
-            target_indexs = np.where(data>0)
-        [img_d, img_h, img_w] = data.shape
-        [max_D, max_H, max_W] = np.max(np.array(target_indexs), axis=1)
-        [min_D, min_H, min_W] = np.min(np.array(target_indexs), axis=1)
-        [target_depth, target_height, target_width] = np.array([max_D, max_H, max_W]) - np.array([min_D, min_H, min_W])
-        Z_min = int((min_D - target_depth*1.0/2) * random())
-        Y_min = int((min_H - target_height*1.0/2) * random())
-        X_min = int((min_W - target_width*1.0/2) * random())
-
-        Z_max = int(img_d - ((img_d - (max_D + target_depth*1.0/2)) * random()))
-        Y_max = int(img_h - ((img_h - (max_H + target_height*1.0/2)) * random()))
-        X_max = int(img_w - ((img_w - (max_W + target_width*1.0/2)) * random()))
-
-        Z_min = np.max([0, Z_min])
-        Y_min = np.max([0, Y_min])
-        X_min = np.max([0, X_min])
-
-        Z_max = np.min([img_d, Z_max])
-        Y_max = np.min([img_h, Y_max])
-        X_max = np.min([img_w, X_max])
-
-        Z_min = int(Z_min)
-        Y_min = int(Y_min)
-        X_min = int(X_min)
-
-        Z_max = int(Z_max)
-        Y_max = int(Y_max)
-        X_max = int(X_max)
+            [min_target, max_target] = _valid_bounds(data > 0)
+        shape = np.array(data.shape)
+        # inclusive upper bound of the target region
+        max_target = max_target - 1
+        target_size = max_target - min_target
+
+        # the three axes at once, truncated towards zero like int()
+        crop_min = np.trunc((min_target - target_size / 2) * np.random.random(3)).astype(int)
+        crop_max = np.trunc(shape - (shape - (max_target + target_size / 2)) * np.random.random(3)).astype(int)
+        crop_min = np.maximum(crop_min, 0)
+        crop_max = np.minimum(crop_max, shape)
+        crop = tuple(slice(lo, hi) for lo, hi in zip(crop_min, crop_max))
 
         if label is None:
-            return data[Z_min: Z_max, Y_min: Y_max, X_min: X_max]
+            return data[crop]
         else:
-            return data[Z_min: Z_max, Y_min: Y_max, X_min: X_max], label[Z_min: Z_max, Y_min: Y_max, X_min: X_max]
+            return data[crop], label[crop]
 
 
 
-    def __itensity_normalize_one_volume__(self, volume):
+    def __itensity_normalize_one_volume__(self, volume, background_noise=True):
         """
         normalize the itensity of an nd volume based on the mean and std of nonzeor region
         inputs:
             volume: the input nd volume
+            background_noise: fill the zero region with gaussian noise, otherwise leave it as NaN
         outputs:
             out: the normalized nd volume
         """
@@ -216,20 +327,35 @@ class CustomTumorDataset(Dataset):
         pixels = volume[volume > 0]
         mean = pixels.mean()
         std  = pixels.std()
-        out = (volume - mean)/std
-        out_random = np.random.normal(0, 1, size = volume.shape)
-        out[volume == 0] = out_random[volume == 0]
+        background = volume == 0
+        foreground = ~background
+        out = np.empty(volume.shape, dtype=np.float32)
+        np.subtract(volume, mean, out=out, where=foreground)
+        np.divide(out, std, out=out, where=foreground)
+        if background_noise:
+            # background noise comes from a pool four volumes large instead of being drawn per sample
+            out[background] = _background_noise(np.count_nonzero(background), 4 * volume.size)
+        else:
+            out[background] = np.nan
         return out
 
     def __resize_data__(self, data):
         """
         Resize the data to the input size
         """
-        [width, depth, height] = data.shape
-        scale = [self.input_W*1.0/width, self.input_D*1.0/depth, self.input_H*1.0/height]
-        data = ndimage.interpolation.zoom(data, scale, order=0)
+        # nearest neighbour resize as a single index gather
+        index = np.ix_(*self.__resize_index__(data.shape))
 
-        return data
+        return data[index]
+
+    def __resize_index__(self, shape):
+        """
+        Source indices of the nearest neighbour resize to the input size, one vector per axis
+        """
+        [width, depth, height] = shape
+        return (_nearest_index(width, self.input_W),
+                _nearest_index(depth, self.input_D),
+                _nearest_index(height, self.input_H))
 
 
     def __crop_data__(self, data, label=None):
@@ -247,30 +373,28 @@ class CustomTumorDataset(Dataset):
     def __training_data_process__(self, data, label=None):
         if label is None:
             # For classification
-            # get data from nii and returns an array. According to the documentation,
-            # get_data() is deprecated, consider changing to get_fdata() or numpy.asanyarray(img.dataobj)
-            data = data.get_data()
-            #data = data[:,:,:,0]
-
             # drop out the invalid range
             data = self.__drop_invalid_range__(data)
+            #data = data[:,:,:,0]
 
             # crop data
             #data = self.__crop_data__(data)
 
+            # the background is left as NaN, __getitem__ fills it with fresh noise after the disk cache
+            if resize_normalize is not None:
+                # resize and normalization fused into one numba kernel
+                return resize_normalize(data, *self.__resize_index__(data.shape))
+
             # resize data
             data = self.__resize_data__(data)
 
             # normalization data
-            data = self.__itensity_normalize_one_volume__(data)
+            data = self.__itensity_normalize_one_volume__(data, background_noise=False)
 
             return data
         else:
             # crop data according net input size
             # For segmentation, WIP
-            data = data.get_data()
-            label = label.get_data()
-
             # drop out the invalid range
             data, label = self.__drop_invalid_range__(data, label)
 
@@ -291,9 +415,8 @@ class CustomTumorDataset(Dataset):
     def __testing_data_process__(self, data, segmentation = False):
         if segmentation is False:
             # For classification
-            # get data from nii and returns an array. According to the documentation,
-            # get_data() is deprecated, consider changing to get_fdata() or numpy.asanyarray(img.dataobj)
-            data = data.get_data()
+            # materialize the volume without forcing a C-ordered copy
+            data = np.asanyarray(data)
             #data = data[:,:,:,0]
 
             # drop out the invalid range
@@ -312,8 +435,8 @@ class CustomTumorDataset(Dataset):
         else:
             # crop data according net input size
             # For segmentation, WIP
-            data = data.get_data()
-            label = label.get_data()
+            data = np.asanyarray(data)
+            label = np.asanyarray(label)
 
             # drop out the invalid range
             # data, label = self.__drop_invalid_range__(data, label)
@@ -0,0 +1,50 @@
+'''
+Numba kernels for the dataset preprocessing
+'''
+
+import numpy as np
+from numba import njit, prange
+
+
+# fast math without the no-NaN assumption, the zero region is written as NaN
+@njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, error_model='numpy', cache=True)
+def resize_normalize(volume, index_0, index_1, index_2):
+    """
+    Fused nearest neighbour resize and itensity normalization, equivalent to
+    __resize_data__ followed by __itensity_normalize_one_volume__
+    inputs:
+        volume: the cropped nd volume
+        index_0, index_1, index_2: source index of each output voxel along the three axes
+    outputs:
+        out: the resized float32 volume, normalized by the mean and std of its nonzero region,
+             with NaN in its zero region; the caller fills it with noise drawn from np.random,
+             as numba's own generator would ignore np.random.seed and the DataLoader worker seeding
+    """
+    n_0, n_1, n_2 = len(index_0), len(index_1), len(index_2)
+    out = np.empty((n_0, n_1, n_2), dtype=np.float32)
+
+    # gather the resized volume and accumulate the statistics of its nonzero region
+    total = 0.0
+    total_sq = 0.0
+    count = 0
+    for i in prange(n_0):
+        for j in range(n_1):
+            for k in range(n_2):
+                value = np.float64(volume[index_0[i], index_1[j], index_2[k]])
+                out[i, j, k] = value
+                if value > 0:
+                    total += value
+                    total_sq += value * value
+                    count += 1
+    mean = total / count
+    std = np.sqrt(max(total_sq / count - mean * mean, 0.0))
+
+    # normalize in place, marking the zero region
+    for i in prange(n_0):
+        for j in range(n_1):
+            for k in range(n_2):
+                if out[i, j, k] == 0:
+                    out[i, j, k] = np.nan
+                else:
+                    out[i, j, k] = (out[i, j, k] - mean) / std
+    return out
@@ -52,6 +52,7 @@ def test(data_loader, model, img_names, sets):
         volume = batch_data
         if not sets.no_cuda:
             volume = volume.cuda()
+        volume = volume.float()
         with torch.no_grad():
             probs = model(volume)
             probs = F.softmax(probs, dim=1)
@@ -49,6 +49,11 @@ def parse_opts():
         default=10,
         type=int,
         help='Interation for saving model')
+    parser.add_argument(
+        '--log_intervals',
+        default=10,
+        type=int,
+        help='Number of batches between training loss logs')
     parser.add_argument(
         '--n_epochs',
         default=2,
@@ -93,6 +98,9 @@ def parse_opts():
     parser.add_argument(
         '--no_cuda', action='store_true', help='If true, cuda is not used.')
     parser.set_defaults(no_cuda=False)
+    parser.add_argument(
+        '--no_amp', action='store_true', help='If true, mixed precision training is not used.')
+    parser.set_defaults(no_amp=False)
     parser.add_argument(
         '--gpu_id',
         nargs='+',
@@ -115,6 +123,11 @@ def parse_opts():
         help='Shortcut type of resnet (A | B)')
     parser.add_argument(
         '--manual_seed', default=1, type=int, help='Manually set random seed')
+    parser.add_argument(
+        '--cache_dir',
+        default=None,
+        type=str,
+        help='Directory for caching preprocessed training volumes, background noise is still drawn per epoch (disabled if not set)')
     parser.add_argument(
         '--ci_test', action='store_true', help='If true, ci testing is used.')
     args = parser.parse_args()
@@ -8,6 +8,7 @@ from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
 import time
 from utils.logger import log
+from utils.data_prefetcher import CUDAPrefetcher
 from scipy import ndimage
 import os
 from datasets.custom_dataset import CustomTumorDataset
@@ -26,6 +27,21 @@ def train(data_loader, model, optimizer, scheduler, total_epochs, save_interval,
     print("\n\n")
     if not sets.no_cuda:
         loss_func = loss_func.cuda()
+        # copy the next batch to the GPU while the current one is being processed
+        train_batches = CUDAPrefetcher(data_loader)
+        validation_batches = CUDAPrefetcher(validation_loader)
+    else:
+        train_batches = data_loader
+        validation_batches = validation_loader
+    # mixed precision on the GPU, always float16 with loss scaling: the nn.DataParallel replicas
+    # re-enter autocast with only its enabled flag, so a bfloat16 setting would not reach them
+    use_amp = not sets.no_cuda and not sets.no_amp
+    amp_dtype = torch.float16
+    try:
+        scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+    except AttributeError:
+        # torch < 2.3
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     model.train()
     train_time_sp = time.time()
@@ -33,40 +49,42 @@ def train(data_loader, model, optimizer, scheduler, total_epochs, save_interval,
     for epoch in range(total_epochs):
         log.info('Start epoch {}'.format(epoch))
 
-        scheduler.step()
         current_lr = scheduler.get_last_lr()[0]
         log.info('lr = {}'.format(current_lr))
         writer.add_scalar("LearningRate", current_lr, epoch)
 
-        for batch_id, batch_data in enumerate(data_loader):
-            correct = 0
-            total = 0
+        correct = 0
+        total = 0
+        running_loss = 0.0
+        for batch_id, batch_data in enumerate(train_batches):
             # getting data batch
             batch_id_sp = epoch * batches_per_epoch
             volumes, label, img_names = batch_data
 
-            if not sets.no_cuda:
-                volumes = volumes.cuda()
+            if not use_amp:
+                # the dataset emits float16, which autocast would otherwise cast for us
+                volumes = volumes.float()
 
             optimizer.zero_grad()
-            out_class = model(volumes)
-            if not sets.no_cuda:
-                out_class = out_class.cuda()
-                label = label.cuda()
-
-            # calculating loss
-            loss = loss_func(out_class, label)
-            loss.backward()
-            optimizer.step()
-            last_loss = loss.item()
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+                out_class = model(volumes)
+
+                # calculating loss
+                loss = loss_func(out_class, label)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             _, predicted = torch.max(out_class.data, 1)
-            correct += (predicted == label).float().sum()
+            # kept on the device, only read back every log_intervals batches and at the end of the epoch
+            running_loss += loss.detach()
+            correct += (predicted == label).sum()
             total += label.size(0)
-            accuracy = 100 * correct / total
-            avg_batch_time = (time.time() - train_time_sp) / (1 + batch_id_sp)
-            log.info(
-                    'Batch: {}(epoch)-{} ({}), loss = {:.3f}, accuracy = {:.3f}, avg_batch_time = {:.3f}'\
-                    .format(epoch, batch_id, batch_id_sp, last_loss, accuracy, avg_batch_time))
+            if (batch_id + 1) % sets.log_intervals == 0:
+                avg_loss = running_loss.item() / (batch_id + 1)
+                avg_batch_time = (time.time() - train_time_sp) / (1 + batch_id_sp)
+                log.info(
+                        'Batch: {}(epoch)-{} ({}), avg_loss = {:.3f}, avg_batch_time = {:.3f}'\
+                        .format(epoch, batch_id, batch_id_sp, avg_loss, avg_batch_time))
 
             # if not sets.ci_test:
             #     # save model
@@ -85,40 +103,43 @@ def train(data_loader, model, optimizer, scheduler, total_epochs, save_interval,
             #                     'optimizer': optimizer.state_dict()},
             #                     model_save_path)
 
+        train_loss = float(running_loss) / (batch_id + 1)
+        train_accuracy = 100 * int(correct) / total
+        log.info('Training loss {}'.format(train_loss))
+        log.info('Training accuracy {}'.format(train_accuracy))
+        writer.add_scalar("Accuracy/train", train_accuracy, epoch)
+
         #Validation per epoch
         with torch.no_grad():
             model.train(False)
             correct = 0
             total = 0
             running_val_loss = 0.0
-            for batch_id, batch_data in enumerate(validation_loader):
+            for batch_id, batch_data in enumerate(validation_batches):
                 batch_id_sp = epoch * batches_per_epoch
                 val_volumes, val_labels, val_img_names = batch_data
+                if not use_amp:
+                    val_volumes = val_volumes.float()
 
-                if not sets.no_cuda:
-                    val_volumes = val_volumes.cuda()
-
-                val_out_class = model(val_volumes)
-
-                if not sets.no_cuda:
-                    val_out_class = val_out_class.cuda()
-                    val_labels = val_labels.cuda()
+                with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+                    val_out_class = model(val_volumes)
+                    val_loss = loss_func(val_out_class, val_labels)
 
                 _, predicted = torch.max(val_out_class.data, 1)
                 total += val_labels.size(0)
-                correct += (predicted == val_labels).float().sum()
+                correct += (predicted == val_labels).sum()
                 #Printing the ones that the model failed to predict
-                for index, item in enumerate(predicted):
-                    if item != val_labels[index]: print(val_img_names[index], " should be ", val_labels[index])
+                wrong = (predicted != val_labels).nonzero(as_tuple=True)[0].tolist()
+                for index in wrong:
+                    print(val_img_names[index], " should be ", val_labels[index].item())
 
-                val_loss = loss_func(val_out_class, val_labels)
-                running_val_loss += val_loss
+                running_val_loss += val_loss.item()
 
-            val_accuracy = 100 * correct / total
+            val_accuracy = 100 * int(correct) / total
             avg_val_loss = running_val_loss / (batch_id + 1)
             log.info('Validation loss {}'.format(avg_val_loss))
             log.info('Validation accuracy {}'.format(val_accuracy))
-            writer.add_scalars("Training vs. Validation Loss", {'Train': last_loss, 'Validation': avg_val_loss}, epoch)
+            writer.add_scalars("Training vs. Validation Loss", {'Train': train_loss, 'Validation': avg_val_loss}, epoch)
             writer.add_scalar("Accuracy/validation", val_accuracy, epoch)
             if avg_val_loss < best_val_loss:
                 best_val_loss = avg_val_loss
@@ -136,6 +157,9 @@ def train(data_loader, model, optimizer, scheduler, total_epochs, save_interval,
 
         #End Validation
 
+        # advance the schedule once the epoch's optimizer steps are done
+        scheduler.step()
+
     #End Epoch
     writer.flush()
     print('Finished training')
@@ -153,6 +177,7 @@ if __name__ == '__main__':
         sets.data_root = './toy_data'
         sets.pretrain_path = ''
         sets.num_workers = 0
+        sets.cache_dir = None
         sets.model_depth = 10
         sets.resnet_shortcut = 'A'
         sets.input_D = 14
@@ -214,8 +239,13 @@ if __name__ == '__main__':
     validation_dataset = CustomTumorDataset(sets.data_root_val, sets)
     print('Training set has {} instances'.format(len(training_dataset)))
     print('Validation set has {} instances'.format(len(validation_dataset)))
-    data_loader = DataLoader(training_dataset, batch_size=sets.batch_size, shuffle=True, num_workers=sets.num_workers, pin_memory=sets.pin_memory)
-    validation_loader = DataLoader(validation_dataset, batch_size=sets.batch_size, shuffle=False, num_workers=sets.num_workers, pin_memory=sets.pin_memory)
+    # keep the workers alive across epochs, these options are only valid with worker processes
+    if sets.num_workers > 0:
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4}
+    else:
+        worker_kwargs = {}
+    data_loader = DataLoader(training_dataset, batch_size=sets.batch_size, shuffle=True, num_workers=sets.num_workers, pin_memory=sets.pin_memory, **worker_kwargs)
+    validation_loader = DataLoader(validation_dataset, batch_size=sets.batch_size, shuffle=False, num_workers=sets.num_workers, pin_memory=sets.pin_memory, **worker_kwargs)
     # training
     train(data_loader, model, optimizer, scheduler, total_epochs=sets.n_epochs, save_interval=sets.save_intervals, save_folder=sets.save_folder, sets=sets)
     writer.close()
@@ -0,0 +1,46 @@
+'''
+Prefetch batches to the GPU while the previous batch is being processed
+'''
+
+import torch
+
+
+class CUDAPrefetcher:
+    """Wraps a DataLoader and copies the next batch to the GPU on a side stream,
+    overlapping the host to device transfer with the forward/backward pass of the current batch.
+
+    The copies are only asynchronous when the DataLoader uses pin_memory=True.
+    Non-tensor items of a batch (e.g. image names) are passed through unchanged.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.__preload__()
+        return self
+
+    def __preload__(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = [item.cuda(non_blocking=True) if torch.is_tensor(item) else item for item in batch]
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        for item in batch:
+            if torch.is_tensor(item):
+                # allocated on the side stream, make sure the memory is not reused while the main stream still needs it
+                item.record_stream(torch.cuda.current_stream())
+        self.__preload__()
+        return batch